@@ -1,6 +1,9 @@
+import collections
 import os
-import struct
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 
 import numpy as np
 
@@ -28,18 +31,18 @@ class PulseGenerator:
         "RESET_WRITE": 4,
         "RETURN": 5,
     }
-    state_map = {
-        0: "IDLE",
-        1: "RESET_READ",
-        2: "RESET_SDRAM",
-        3: "RESET_WRITE",
-        4: "LOAD_0",
-        5: "LOAD_1",
-        6: "LOAD_2",
-        7: "READ_0",
-        8: "READ_1",
-        9: "READ_2",
-    }
+    state_map = (  # indexed by the state id
+        "IDLE",
+        "RESET_READ",
+        "RESET_SDRAM",
+        "RESET_WRITE",
+        "LOAD_0",
+        "LOAD_1",
+        "LOAD_2",
+        "READ_0",
+        "READ_1",
+        "READ_2",
+    )
 
     def __init__(
         self,
@@ -73,14 +76,22 @@ class PulseGenerator:
         core="12x8",
     ):
         self.serial = serial
-        self.channel_map = channel_map
+        # a private read-only copy, the caches below depend on it
+        self._channel_map = MappingProxyType(dict(channel_map))
         self.xem = ok.FrontPanel()
+        # compiles sequences while 'setSequence' halts the FPGA
+        self._compiler = ThreadPoolExecutor(max_workers=1)
         self.open_usb()
         self.load_core(core)
         self.setResetValue(0x00000000)
         self.reset()
         self.checkUnderflow()
 
+    @property
+    def channel_map(self):
+        """Read-only mapping of channel names to channel numbers."""
+        return self._channel_map
+
     def open_usb(self):
         if self.xem.OpenBySerial(self.serial) != 0:
             raise RuntimeError("failed to open USB connection.")
@@ -120,6 +131,23 @@ class PulseGenerator:
                 raise RuntimeError("FPGA core does not match.")
         else:
             raise ValueError('core must be "12x8" or "24x4"')
+        # wire-in values last staged for the freshly configured FPGA,
+        # address -> (value, known bits)
+        self._wire_ins = {}
+        self._wires_dirty = False
+        self._mask_cache = {}  # channel set -> bit mask
+        self._spread_cache = {}  # bit mask -> spread mask, see '_spread_mask'
+        # compiled binaries of the most recent sequences, least recently used first,
+        # see 'convertSequenceToBinary'. Also filled from the compiler thread.
+        self._binary_cache = collections.OrderedDict()
+        self._binary_lock = threading.Lock()
+        # a pulser instruction is the 32 bit repetition word followed by the channel
+        # patterns, transferred as little endian 16 bit words, most significant first
+        self._pattern_bits = self.n_channels * self.channel_width
+        self._instruction_size = 4 + self._pattern_bits // 8
+        self._swap_mask = int(
+            "00FF" * (self._instruction_size // 2), 16
+        )  # low byte of every 16 bit word
 
     def getInfo(self):
         """Returns the number of channels and channel width."""
@@ -162,39 +190,97 @@ class PulseGenerator:
                 + "' state."
             )
 
+    def _wait_state(self, wanted, timeout=0.1):
+        """
+        Polls the FPGA state until it is the 'wanted' state,
+        or any of them if 'wanted' is a tuple of states.
+
+        Raises a 'RuntimeError' if the state is not reached within 'timeout' seconds.
+        Each poll is a USB round-trip, which paces the loop.
+        """
+        if isinstance(wanted, str):
+            wanted = (wanted,)
+        deadline = time.perf_counter() + timeout
+        actual = self.getState()
+        while actual not in wanted:
+            if time.perf_counter() > deadline:
+                raise RuntimeError(
+                    "FPGA State Error. Expected '"
+                    + "' or '".join(wanted)
+                    + "' state but got '"
+                    + actual
+                    + "' state."
+                )
+            actual = self.getState()
+
+    def _set_wire(self, address, value, mask):
+        """
+        Stages a wire-in value, to be sent to the FPGA by '_flush_wires'.
+
+        Values that the FPGA already has are not staged again.
+        """
+        old, known = self._wire_ins.get(address, (0, 0))
+        new = old & ~mask | value & mask
+        if known & mask == mask and new == old:
+            return
+        self.xem.SetWireInValue(address, value, mask)
+        self._wire_ins[address] = (new, known | mask)
+        self._wires_dirty = True
+
+    def _flush_wires(self):
+        """Sends all staged wire-in values to the FPGA in a single USB transfer."""
+        if self._wires_dirty:
+            self.xem.UpdateWireIns()
+            self._wires_dirty = False
+
     def enableTrigger(self):
-        self.xem.SetWireInValue(0x00, 0xFF, 2)
-        self.xem.UpdateWireIns()
+        self._set_wire(0x00, 0xFF, 2)
+        self._flush_wires()
 
     def disableTrigger(self):
-        self.xem.SetWireInValue(0x00, 0x00, 2)
-        self.xem.UpdateWireIns()
+        self._set_wire(0x00, 0x00, 2)
+        self._flush_wires()
 
     def enableDecoder(self):
-        self.xem.SetWireInValue(0x00, 0x00, 1)
-        self.xem.UpdateWireIns()
+        self._set_wire(0x00, 0x00, 1)
+        self._flush_wires()
 
     def disableDecoder(self):
-        self.xem.SetWireInValue(0x00, 0xFF, 1)
-        self.xem.UpdateWireIns()
+        self._set_wire(0x00, 0xFF, 1)
+        self._flush_wires()
 
     def run(self, triggered=False):
         self.halt()
+        self._start(triggered)
+
+    def _start(self, triggered, loop=False):
+        """
+        Starts reading the loaded sequence.
+
+        The FPGA must be 'IDLE' with the decoder disabled. 'loop' tells whether
+        the loaded sequence repeats indefinitely; only then is the core known
+        to keep reading after RUN.
+        """
         if triggered:
             self.enableTrigger()
         else:
             self.disableTrigger()
         self.ctrlPulser("RESET_READ")
-        time.sleep(0.01)
+        self._wait_state("IDLE")
         self.ctrlPulser("RUN")
-        time.sleep(0.01)
+        if loop and not triggered:
+            self._wait_state(("READ_0", "READ_1", "READ_2"))
+        else:
+            # the core may hold until the external trigger arrives, or a sequence that
+            # runs once may already have reached its end, so only let it settle
+            time.sleep(0.01)
         self.enableDecoder()
 
     def halt(self):
         self.disableDecoder()
         time.sleep(0.01)
         self.ctrlPulser("RETURN")
-        self.checkState("IDLE")
+        self._wait_state("IDLE")
 
     def loadPages(self, buf):
         if len(buf) % 1024 != 0:
@@ -203,30 +289,40 @@ class PulseGenerator:
             )
         self.disableDecoder()
         self.ctrlPulser("RESET_WRITE")
-        time.sleep(0.01)
+        self._wait_state("IDLE")
+        # the core enters LOAD_0 right away, it is checked after the transfer
         self.ctrlPulser("LOAD")
-        self.checkState("LOAD_0")
-        bytes = self.xem.WriteToBlockPipeIn(0x80, 1024, buf)
+        # all pages go out in a single block pipe transfer of 1024 byte blocks
+        ret = self.xem.WriteToBlockPipeIn(0x80, 1024, buf)
+        if ret != len(buf):
+            raise RuntimeError(
+                "failed to write pages to the FPGA. Wrote %i of %i bytes."
+                % (ret, len(buf))
+            )
+        # LOAD_0 does not tell whether the FIFO has reached the SDRAM yet, let it settle
         time.sleep(0.01)
         self.checkState("LOAD_0")
         self.ctrlPulser("RETURN")
         self.checkState("IDLE")
-        return bytes
+        return ret
 
     def reset(self):
         self.disableDecoder()
         self.ctrlPulser("RESET_WRITE")
-        time.sleep(0.001)
+        self._wait_state("IDLE")
         self.ctrlPulser("RESET_READ")
-        time.sleep(0.001)
+        self._wait_state("IDLE")
         self.ctrlPulser("RESET_SDRAM")
-        time.sleep(0.01)
+        self._wait_state("IDLE")
 
     def setResetValue(self, bits):
-        self.xem.SetWireInValue(0x01, bits, 0xFFFF)
+        self._stage_reset_value(bits)
+        self._flush_wires()
+
+    def _stage_reset_value(self, bits):
+        self._set_wire(0x01, bits, 0xFFFF)
         if self.core == "24x4":
-            self.xem.SetWireInValue(0x02, bits >> 16, 0xFFFF)
-        self.xem.UpdateWireIns()
+            self._set_wire(0x02, bits >> 16, 0xFFFF)
 
     def checkUnderflow(self):
         self.xem.UpdateTriggerOuts()
@@ -234,32 +330,63 @@ class PulseGenerator:
 
     def createBitsFromChannels(self, channels):
         """
-        Convert a list of channel names into an array of bools of length N_CHANNELS,
-        that specify the state (high or low) of each available channel.
+        Convert a list of channel names into an integer bit mask,
+        where bit i specifies the state (high or low) of channel i.
+
+        Sequences reuse the same few channel sets many times, so the result
+        is cached per set of channel names.
         """
-        bits = np.zeros(self.n_channels, dtype=bool)
-        for channel in channels:
-            bits[self.channel_map[channel]] = True
-        return bits
+        key = frozenset(channels)
+        try:
+            return self._mask_cache[key]
+        except KeyError:
+            pass
+        mask = 0
+        for channel in key:
+            mask |= 1 << self.channel_map[channel]
+        self._mask_cache[key] = mask
+        return mask
+
+    def setBits(self, pattern, start, count, mask):
+        """
+        Returns 'pattern' with the bits in the range start:start+count set
+        for every channel that is high in 'mask'.
 
-    def setBits(self, integers, start, count, bits):
-        """Sets the bits in the range start:start+count in integers[i] to bits[i]."""
+        'pattern' is a single integer holding the serializer words of all channels,
+        channel i occupying bits i*CHANNEL_WIDTH to (i+1)*CHANNEL_WIDTH-1.
+        """
         # ToDo: check bit order (depending on whether least significant or most significant bit is shifted out first from serializer)
-        for i in range(self.n_channels):
-            if bits[i]:
-                integers[i] = integers[i] | (2**count - 1) << start
+        # the spread mask has the lowest bit of each high channel set, so multiplying
+        # shifts the block into every high channel at once (blocks never overlap)
+        return pattern | self._spread_mask(mask) * (((1 << count) - 1) << start)
+
+    def _spread_mask(self, mask):
+        """Moves bit i of a channel mask to bit i*CHANNEL_WIDTH. Cached per mask."""
+        try:
+            return self._spread_cache[mask]
+        except KeyError:
+            pass
+        width = self.channel_width
+        spread = sum(1 << i * width for i in range(self.n_channels) if mask >> i & 1)
+        self._spread_cache[mask] = spread
+        return spread
 
     def pack(self, mult, pattern):
+        buf = bytearray(self._instruction_size)
+        self.pack_into(buf, 0, mult, pattern)
+        return bytes(buf)
+
+    def pack_into(self, buf, offset, mult, pattern):
+        """Writes the instruction for 'mult' and 'pattern' into 'buf' at 'offset'."""
         # ToDo: check whether max repetitions is exceeded, split into several commands if necessary
-        if self.core == "24x4":
-            pattern = [
-                pattern[i] | pattern[i + 1] << 4 for i in range(0, len(pattern), 2)
-            ]
-        s = struct.pack(">I%iB" % len(pattern), mult, *pattern[::-1])
-        swap = ""
-        for i in range(len(s)):
-            swap += s[i - 1 if i % 2 else i + 1]
-        return swap
+        # channel i sits at bit i*CHANNEL_WIDTH of the pattern, so the integer already
+        # holds the pattern bytes of the instruction, for the 24x4 core with two
+        # channels per byte. Swapping the bytes within each 16 bit word of the whole
+        # instruction at once gives the transfer order.
+        size, swap = self._instruction_size, self._swap_mask
+        word = mult << self._pattern_bits | pattern
+        word = (word & swap) << 8 | (word >> 8) & swap
+        buf[offset : offset + size] = word.to_bytes(size, "big")
 
     def convertSequenceToBinary(self, sequence, loop=True):
         """
@@ -288,76 +415,126 @@ class PulseGenerator:
 
             buf         binary buffer containing N SDRAM pages that represent the sequence
         """
+        # the same sequences are uploaded shot after shot, so the binaries are cached,
+        # keyed by the sequence with hashable, order independent channel sets
+        key = (tuple((frozenset(ch), time) for ch, time in sequence), bool(loop))
+        with self._binary_lock:
+            buf = self._binary_cache.get(key)
+            if buf is not None:
+                self._binary_cache.move_to_end(key)
+                return buf
+        buf = self._convertCanonicalSequence(*key)
+        with self._binary_lock:
+            self._binary_cache[key] = buf
+            if len(self._binary_cache) > 64:
+                self._binary_cache.popitem(last=False)
+        return buf
 
-        dt = self.dt
-        N_CHANNELS, CHANNEL_WIDTH = self.n_channels, self.channel_width
+    def _convertCanonicalSequence(self, sequence, loop):
+        """Uncached 'convertSequenceToBinary'."""
+        n = len(sequence)
+        masks = np.fromiter(
+            (self.createBitsFromChannels(channels) for channels, time in sequence),
+            dtype=np.int64,
+            count=n,
+        )
+        times = np.fromiter(
+            (time for channels, time in sequence), dtype=np.float64, count=n
+        )
+        durations = np.rint(times / self.dt).astype(
+            np.int64
+        )  # convert the times into integer multiples of hardware time steps
+        return self._compileSequence(masks, durations, loop)
+
+    def _compileSequence(self, masks, durations, loop):
+        """
+        Numeric core of 'convertSequenceToBinary'.
+
+        Works on plain integers only: 'masks' are the channel bit masks
+        (see 'createBitsFromChannels') and 'durations' the tick counts
+        of the sequence steps, both given as int64 arrays.
+        """
+        CHANNEL_WIDTH = self.channel_width
         ONES = 2**CHANNEL_WIDTH - 1
         REP_MAX = 2**31
-        buf = ""
-        # we start with an integer zero for each channel.
-        # In the following, we will start filling up the bits in each of these integers
-        blank = np.zeros(
-            N_CHANNELS, dtype=int
-        )  # we will need this many times, so we create it once and copy from this
-        pattern = blank.copy()
+        SIZE = self._instruction_size
+        # every step writes at most a block fill, a repetition command and the
+        # REP_MAX multiples, the end of the sequence at most three instructions.
+        # The buffer starts out zeroed, so the page padding comes for free.
+        nonzero = durations != 0  # steps that round to zero ticks are dropped
+        masks, durations = masks[nonzero], durations[nonzero]
+        n_max = 2 * len(masks) + 3 + int((durations // (CHANNEL_WIDTH * REP_MAX)).sum())
+        buf = bytearray(-(-n_max * SIZE // 1024) * 1024)
+        offset = 0
+        # bind the helpers to locals, this loop is the hot path of every sequence upload
+        set_bits = self.setBits
+        spread_mask = self._spread_mask
+        pack_into = self.pack_into
+        last_rep, last_block = 0, None
+
+        def emit(rep, block):
+            """Writes an instruction, merged into the previous one on equal patterns."""
+            nonlocal offset, last_rep, last_block
+            if block == last_block and last_rep + rep + 1 < REP_MAX:
+                last_rep += rep + 1  # rep=0 means the block is executed once
+                pack_into(buf, offset - SIZE, last_rep, block)
+            else:
+                pack_into(buf, offset, rep, block)
+                offset += SIZE
+                last_rep, last_block = rep, block
+
+        # the serializer words of all channels are held in a single integer,
+        # starting from zero. In the following, we will start filling up its bits
+        pattern = 0
         index = 0
-        for channels, time in sequence:
-            ticks = int(
-                round(time / dt)
-            )  # convert the time into an integer multiple of hardware time steps
-            if ticks == 0:
-                continue
-            bits = self.createBitsFromChannels(channels)
+        # iterate over python ints, the channel patterns do not fit into 64 bits
+        for bits, ticks in zip(masks.tolist(), durations.tolist()):
             if (
                 index + ticks < CHANNEL_WIDTH
             ):  # if pattern does not fill current block, insert into current block and continue
-                self.setBits(pattern, index, ticks, bits)
+                pattern = set_bits(pattern, index, ticks, bits)
                 index += ticks
                 continue
             if (
                 index > 0
             ):  # else fill current block with pattern, reduce ticks accordingly, write block and start a new block
-                self.setBits(pattern, index, CHANNEL_WIDTH - index, bits)
-                buf += self.pack(0, pattern)
+                pattern = set_bits(pattern, index, CHANNEL_WIDTH - index, bits)
+                emit(0, pattern)
                 ticks -= CHANNEL_WIDTH - index
-                pattern = blank.copy()
+                pattern = 0
             # split possible remaining ticks into a command with repetitions and a single block for the remainder
-            repetitions = ticks / CHANNEL_WIDTH  # number of full blocks
+            repetitions = ticks // CHANNEL_WIDTH  # number of full blocks
             index = (
                 ticks % CHANNEL_WIDTH
             )  # remainder will make the beginning of a new block
             if repetitions > 0:
+                full = spread_mask(bits) * ONES
                 if repetitions > REP_MAX:
-                    multiplier = repetitions / REP_MAX
+                    multiplier = repetitions // REP_MAX
                     repetitions = repetitions % REP_MAX
-                    buf += multiplier * self.pack(REP_MAX - 1, ONES * bits)
-                buf += self.pack(
-                    repetitions - 1, ONES * bits
-                )  # rep=0 means the block is executed once
+                    for _ in range(multiplier):
+                        emit(REP_MAX - 1, full)
+                # nothing left if ticks was a multiple of REP_MAX blocks
+                if repetitions > 0:
+                    # rep=0 means the block is executed once
+                    emit(repetitions - 1, full)
             if index > 0:
-                pattern = blank.copy()
-                self.setBits(pattern, 0, index, bits)
+                pattern = set_bits(0, 0, index, bits)
         if loop:  # repeat the hole sequence
-            if index > 0:  # fill up incomplete block with zeros and write it
-                self.setBits(
-                    pattern,
-                    index,
-                    CHANNEL_WIDTH - index,
-                    np.zeros(N_CHANNELS, dtype=bool),
-                )
-                buf += self.pack(0, pattern)
+            if index > 0:
+                # the remaining bits of the incomplete block are zero, write it
+                emit(0, pattern)
         else:  # stop after one execution
             if index > 0:  # fill up the incomplete block with the bits of the last step
-                self.setBits(pattern, index, CHANNEL_WIDTH - index, bits)
-                buf += self.pack(0, pattern)
-            buf += self.pack(1 << 31, ONES * bits)
-            buf += self.pack(1 << 31, ONES * bits)
-        # print "buf has",len(buf)," bytes"
-        buf = (
-            buf + ((1024 - len(buf)) % 1024) * "\x00"
-        )  # pad buffer with zeros so it matches SDRAM / FIFO page size
-        # print "buf has",len(buf)," bytes"
-        return buf
+                pattern = set_bits(pattern, index, CHANNEL_WIDTH - index, bits)
+                emit(0, pattern)
+            full = spread_mask(bits) * ONES
+            pack_into(buf, offset, 1 << 31, full)
+            pack_into(buf, offset + SIZE, 1 << 31, full)
+            offset += 2 * SIZE
+        # drop unused pages, the zeros left pad the buffer to the SDRAM / FIFO page size
+        del buf[-(-offset // 1024) * 1024 :]
+        return bytes(buf)
 
     def setSequence(self, sequence, loop=True, triggered=False):
         """
@@ -374,9 +551,12 @@ class PulseGenerator:
             triggered     bool, defaults to False, specifies whether the execution
                           should be delayed until an external trigger is received
         """
+        # compile the sequence while halt waits for the decoder to settle,
+        # the compilation does not touch the USB connection
+        future = self._compiler.submit(self.convertSequenceToBinary, sequence, loop)
         self.halt()
-        self.loadPages(self.convertSequenceToBinary(sequence, loop))
-        self.run(triggered)
+        self.loadPages(future.result())
+        self._start(triggered, loop)  # loadPages leaves the FPGA halted
 
     def setContinuous(self, channels):
         """
@@ -392,13 +572,10 @@ class PulseGenerator:
         try:
             iter(channels)
         except:
-            self.setResetValue(channels)
+            self._stage_reset_value(channels)
         else:
-            bits = 0
-            for channel in channels:
-                bits = bits | (1 << self.channel_map[channel])
-            self.setResetValue(bits)
-        self.halt()
+            self._stage_reset_value(self.createBitsFromChannels(channels))
+        self.halt()  # sends the reset value together with the decoder switch-off
 
 
 ########## TESTCODE############